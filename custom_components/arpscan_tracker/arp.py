@@ -0,0 +1,330 @@
+"""
+Native ARP prober using a raw AF_PACKET socket.
+
+Sends one ARP request per target address and collects the replies,
+without spawning the arp-scan binary. Requires Linux and CAP_NET_RAW.
+"""
+import ctypes
+import errno
+import fcntl
+import ipaddress
+import os
+import select
+import socket
+import struct
+import time
+
+ETH_P_ARP = 0x0806
+ARPOP_REQUEST = 1
+ARPOP_REPLY = 2
+
+SIOCGIFADDR = 0x8915
+SIOCGIFNETMASK = 0x891b
+SIOCGIFHWADDR = 0x8927
+
+BROADCAST_MAC = b'\xff' * 6
+ZERO_MAC = b'\x00' * 6
+
+# Ethernet header + ARP payload for IPv4 over Ethernet (42 bytes).
+ARP_FRAME = struct.Struct('!6s6sHHHBBH6s4s6s4s')
+# Offsets into ARP_FRAME of the fields we read back or rewrite.
+OPER_OFFSET = 20
+SHA_OFFSET = 22
+TPA_OFFSET = 38
+
+DEFAULT_TIMEOUT = 1.0
+
+# Most messages the kernel accepts in one sendmmsg() call (UIO_MAXIOV).
+SENDMMSG_MAX = 1024
+# Most addresses probed natively (a /22). Requests go out in one unpaced
+# burst, larger networks are left to arp-scan which rate-limits them.
+MAX_TARGETS = 1024
+# Frame batches kept per prober: the full sweep and the known hosts.
+BATCH_CACHE_SIZE = 2
+
+
+class _IOVec(ctypes.Structure):
+    _fields_ = [
+        ('iov_base', ctypes.c_void_p),
+        ('iov_len', ctypes.c_size_t),
+    ]
+
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_name', ctypes.c_void_p),
+        ('msg_namelen', ctypes.c_uint32),
+        ('msg_iov', ctypes.c_void_p),
+        ('msg_iovlen', ctypes.c_size_t),
+        ('msg_control', ctypes.c_void_p),
+        ('msg_controllen', ctypes.c_size_t),
+        ('msg_flags', ctypes.c_int),
+    ]
+
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_hdr', _MsgHdr),
+        ('msg_len', ctypes.c_uint),
+    ]
+
+
+try:
+    _sendmmsg = ctypes.CDLL(None, use_errno=True).sendmmsg
+except (AttributeError, OSError):
+    _sendmmsg = None
+else:
+    _sendmmsg.argtypes = [
+        ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+    _sendmmsg.restype = ctypes.c_int
+
+
+def _ifreq(interface):
+    """Pack an ifreq structure for the given interface name."""
+    return struct.pack('256s', interface.encode()[:15])
+
+
+def get_default_interface():
+    """
+    Return the interface of the default route.
+    Falls back to the first non-loopback interface with an IPv4 address.
+    """
+    try:
+        with open('/proc/net/route') as routes:
+            next(routes, None)
+            for line in routes:
+                fields = line.split()
+                if len(fields) > 1 and fields[1] == '00000000':
+                    return fields[0]
+    except OSError:
+        pass
+
+    for _, name in socket.if_nameindex():
+        if name == 'lo':
+            continue
+        try:
+            get_interface_info(name)
+        except OSError:
+            continue
+        return name
+    return None
+
+
+def get_interface_info(interface):
+    """Return (mac, ip, netmask) of an interface as raw bytes."""
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        ifreq = _ifreq(interface)
+        hwaddr = fcntl.ioctl(sock.fileno(), SIOCGIFHWADDR, ifreq)
+        addr = fcntl.ioctl(sock.fileno(), SIOCGIFADDR, ifreq)
+        netmask = fcntl.ioctl(sock.fileno(), SIOCGIFNETMASK, ifreq)
+    return hwaddr[18:24], addr[20:24], netmask[20:24]
+
+
+def get_interface_network(interface):
+    """Return the IPv4 network an interface is attached to."""
+    _, addr, netmask = get_interface_info(interface)
+    addr = int.from_bytes(addr, 'big')
+    netmask = int.from_bytes(netmask, 'big')
+    return ipaddress.IPv4Network((addr & netmask, bin(netmask).count('1')))
+
+
+def network_range(network):
+    """Return the first and last host address of a network as integers."""
+    first = int(network.network_address)
+    last = int(network.broadcast_address)
+    # Skip network and broadcast address, like IPv4Network.hosts()
+    if last - first > 1:
+        first += 1
+        last -= 1
+    return first, last
+
+
+def range_targets(ranges):
+    """Expand (first, last) address ranges into a list of 32-bit integers."""
+    count = sum(last - first + 1 for first, last in ranges)
+    if count > MAX_TARGETS:
+        raise ValueError("{} addresses to probe, at most {} supported".format(
+            count, MAX_TARGETS))
+
+    targets = []
+    for first, last in ranges:
+        targets.extend(range(first, last + 1))
+    return targets
+
+
+class _FrameBatch:
+    """ARP request frames for a list of targets, laid out for sendmmsg()."""
+
+    def __init__(self, template, targets):
+        """Build one frame per target in a single contiguous buffer."""
+        self.targets = targets
+        self.size = size = len(template)
+        self.count = count = len(targets)
+
+        self.frames = bytearray(template) * count
+        for index, target in enumerate(targets):
+            struct.pack_into('!I', self.frames, index * size + TPA_OFFSET,
+                             target)
+
+        self._msgs = None
+        if _sendmmsg is not None and count:
+            self._buffer = (ctypes.c_char * len(self.frames)).from_buffer(
+                self.frames)
+            self._iovecs = (_IOVec * count)()
+            self._msgs = (_MMsgHdr * count)()
+            base = ctypes.addressof(self._buffer)
+            iov_base = ctypes.addressof(self._iovecs)
+            iov_size = ctypes.sizeof(_IOVec)
+            for index in range(count):
+                iovec = self._iovecs[index]
+                iovec.iov_base = base + index * size
+                iovec.iov_len = size
+                header = self._msgs[index].msg_hdr
+                header.msg_iov = iov_base + index * iov_size
+                header.msg_iovlen = 1
+
+    def sendmmsg(self, sock):
+        """Send all frames with as few sendmmsg() calls as possible."""
+        if not self.count:
+            return
+        if self._msgs is None:
+            raise OSError(errno.ENOSYS, os.strerror(errno.ENOSYS))
+
+        fd = sock.fileno()
+        base = ctypes.addressof(self._msgs)
+        step = ctypes.sizeof(_MMsgHdr)
+        sent = 0
+        while sent < self.count:
+            result = _sendmmsg(fd, base + sent * step,
+                               min(self.count - sent, SENDMMSG_MAX), 0)
+            if result < 0:
+                err = ctypes.get_errno()
+                if err == errno.EINTR:
+                    continue
+                raise OSError(err, os.strerror(err))
+            sent += result
+
+    def send(self, sock):
+        """Send all frames one send() call at a time."""
+        frames = memoryview(self.frames)
+        for offset in range(0, len(frames), self.size):
+            sock.send(frames[offset:offset + self.size])
+
+
+class ArpProber:
+    """Send ARP requests on an interface and collect the replies."""
+
+    def __init__(self, interface, timeout=DEFAULT_TIMEOUT):
+        """Open the raw socket and prepare the request template."""
+        self.interface = interface
+        self.timeout = timeout
+
+        self.mac, self.ip, _ = get_interface_info(interface)
+
+        self._sock = socket.socket(
+            socket.AF_PACKET, socket.SOCK_RAW, socket.htons(ETH_P_ARP))
+        try:
+            self._sock.bind((interface, ETH_P_ARP))
+        except OSError:
+            self._sock.close()
+            raise
+
+        self._frame = bytearray(ARP_FRAME.pack(
+            BROADCAST_MAC, self.mac, ETH_P_ARP,
+            1, 0x0800, 6, 4, ARPOP_REQUEST,
+            self.mac, self.ip, ZERO_MAC, b'\x00' * 4))
+        self._buffer = bytearray(128)
+        self._batches = {}
+        self._use_sendmmsg = _sendmmsg is not None
+
+    def close(self):
+        """Close the raw socket."""
+        self._sock.close()
+
+    def _drain(self):
+        """Discard frames queued on the socket since the last probe."""
+        self._sock.setblocking(False)
+        try:
+            while True:
+                self._sock.recv_into(self._buffer)
+        except BlockingIOError:
+            pass
+        finally:
+            self._sock.setblocking(True)
+
+    def _send(self, targets):
+        """Send an ARP request to every target."""
+        # Batches are keyed on the target list object, which the batch
+        # keeps alive so its id cannot be reused while cached
+        batch = self._batches.pop(id(targets), None)
+        if batch is None:
+            batch = _FrameBatch(self._frame, targets)
+            while len(self._batches) >= BATCH_CACHE_SIZE:
+                del self._batches[next(iter(self._batches))]
+        self._batches[id(targets)] = batch
+
+        if self._use_sendmmsg:
+            try:
+                batch.sendmmsg(self._sock)
+                return
+            except OSError as err:
+                if err.errno != errno.ENOSYS:
+                    raise
+                self._use_sendmmsg = False
+        batch.send(self._sock)
+
+    def _receive(self, expected=None):
+        """
+        Collect ARP replies until the timeout expires, or until every
+        address in expected (32-bit integers) has answered.
+        """
+        sock = self._sock
+        buffer = self._buffer
+        own_mac = self.mac
+        pending = set(expected) if expected is not None else None
+
+        replies = []
+        seen = set()
+        deadline = time.monotonic() + self.timeout
+        while pending is None or pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            readable, _, _ = select.select([sock], [], [], remaining)
+            if not readable:
+                break
+            if sock.recv_into(buffer) < ARP_FRAME.size:
+                continue
+            oper, = struct.unpack_from('!H', buffer, OPER_OFFSET)
+            if oper != ARPOP_REPLY:
+                continue
+            sha, spa, tha = struct.unpack_from('!6s4s6s', buffer, SHA_OFFSET)
+            if tha != own_mac:
+                continue
+            if pending is not None:
+                pending.discard(int.from_bytes(spa, 'big'))
+            if sha in seen:
+                continue
+            seen.add(sha)
+            replies.append((sha, spa))
+
+        return replies
+
+    def probe(self, targets):
+        """
+        Send an ARP request to every target and wait for replies.
+        Returns a list of (mac, ip) tuples as raw bytes.
+        """
+        self._drain()
+        self._send(targets)
+        return self._receive()
+
+    def probe_known(self, targets):
+        """
+        Send an ARP request to a few known hosts and wait for replies,
+        returning as soon as all of them answered.
+        Returns a list of (mac, ip) tuples as raw bytes.
+        """
+        self._drain()
+        self._send(targets)
+        return self._receive(targets)
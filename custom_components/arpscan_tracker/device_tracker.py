@@ -4,10 +4,14 @@ Support for scanning a network with arp-scan.
 For more details about this platform, please refer to the documentation at
 https://github.com/cyberjunky/home-assistant-arpscan_tracker/
 """
+import errno
+import functools
+import ipaddress
 import logging
-import re
+import shlex
+import socket
 import subprocess
-from collections import namedtuple
+import time
 from datetime import timedelta
 
 import voluptuous as vol
@@ -18,6 +22,10 @@ from homeassistant.components.device_tracker import (
     DOMAIN, PLATFORM_SCHEMA, DeviceScanner)
 from homeassistant.util import Throttle
 
+from .arp import (
+    ArpProber, get_default_interface, get_interface_network, network_range,
+    range_targets)
+
 _LOGGER = logging.getLogger(__name__)
 
 CONF_EXCLUDE = 'exclude'
@@ -26,40 +34,172 @@ CONF_OPTIONS = 'scan_options'
 DEFAULT_OPTIONS = '-l -g -t1 -q'
 
 MIN_TIME_BETWEEN_SCANS = timedelta(seconds=5)
+FULL_SCAN_INTERVAL = timedelta(seconds=60)
+
+
+def _ipv4_address(value):
+    """Validate a strict dotted-quad IPv4 address."""
+    value = cv.string(value)
+    try:
+        ipaddress.IPv4Address(value)
+    except ValueError as err:
+        raise vol.Invalid(
+            "invalid IPv4 address: {}".format(value)) from err
+    return value
+
+
+def _scan_options(value):
+    """Validate that scan options can be split into arguments."""
+    value = cv.string(value)
+    try:
+        shlex.split(value)
+    except ValueError as err:
+        raise vol.Invalid(
+            "invalid scan options: {}: {}".format(value, err)) from err
+    return value
+
 
 PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend({
     vol.Optional(CONF_INCLUDE, default=[]):
-        vol.All(cv.ensure_list, [cv.string]),
+        vol.All(cv.ensure_list, [_ipv4_address]),
     vol.Optional(CONF_EXCLUDE, default=[]):
-        vol.All(cv.ensure_list, [cv.string]),
+        vol.All(cv.ensure_list, [_ipv4_address]),
     vol.Optional(CONF_OPTIONS, default=DEFAULT_OPTIONS):
-        cv.string
+        _scan_options
 })
 
 
+# arp-scan options that take a value, so it is not mistaken for a target
+_SHORT_OPTIONS_WITH_ARG = frozenset('aAbBfFHiImMnoOpPQrsStTuwWy')
+_LONG_OPTIONS_WITH_ARG = frozenset((
+    'arphln', 'arpop', 'arppln', 'arppro', 'arpsha', 'arpspa', 'arptha',
+    'arphrd', 'backoff', 'bandwidth', 'destaddr', 'file', 'format',
+    'iabfile', 'interface', 'interval', 'limit', 'macfile', 'ouifile',
+    'padding', 'pcapsavefile', 'prototype', 'randomseed', 'retry', 'snap',
+    'srcaddr', 'timeout', 'vlan'))
+# arp-scan options changing what is probed or how the requests look, which
+# the native prober does not implement
+_ARP_SCAN_ONLY_OPTIONS = frozenset((
+    'a', 'arphln', 'A', 'padding', 'f', 'file', 'H', 'arphrd', 'L', 'llc',
+    'o', 'arpop', 'p', 'arppro', 'P', 'arppln', 'Q', 'vlan', 's', 'arpspa',
+    'S', 'srcaddr', 'T', 'destaddr', 'u', 'arpsha', 'w', 'arptha',
+    'y', 'prototype'))
+
+
+def _parse_target(target):
+    """
+    Return the (first, last) address range of an arp-scan target.
+    Supports addresses, network/bits, network:mask and first-last ranges,
+    returns None for anything else (like hostnames).
+    """
+    try:
+        if '-' in target:
+            first, last = (int(ipaddress.IPv4Address(address))
+                           for address in target.split('-', 1))
+            return (first, last) if first <= last else None
+        return network_range(
+            ipaddress.IPv4Network(target.replace(':', '/'), strict=False))
+    except ValueError:
+        return None
+
+
+@functools.lru_cache(maxsize=16)
+def _parse_scan_options(options):
+    """
+    Extract the interface and target address ranges from arp-scan options
+    (a tuple of arguments).
+    The ranges are None when the options need arp-scan: targets only it
+    can handle (target files, hostnames) or options changing the requests
+    (VLAN, source addresses, ...).
+    """
+    interface = None
+    ranges = []
+    supported = True
+    args = iter(options)
+    for arg in args:
+        if arg.startswith('--'):
+            name, has_value, value = arg[2:].partition('=')
+            if name in _LONG_OPTIONS_WITH_ARG and not has_value:
+                value = next(args, None)
+            names = [name]
+        elif arg.startswith('-') and len(arg) > 1:
+            # Short flags can be bundled, one taking a value ends the bundle
+            names = []
+            value = None
+            for index, flag in enumerate(arg[1:], 2):
+                names.append(flag)
+                if flag in _SHORT_OPTIONS_WITH_ARG:
+                    value = arg[index:] or next(args, None)
+                    break
+            name = names[-1]
+        else:
+            target = _parse_target(arg)
+            if target is None:
+                supported = False
+            else:
+                ranges.append(target)
+            continue
+
+        if name in ('I', 'interface'):
+            interface = value
+        if _ARP_SCAN_ONLY_OPTIONS.intersection(names):
+            supported = False
+    return interface, tuple(ranges) if supported else None
+
+
+def _ip_keys(hosts):
+    """Return the 32-bit integer keys of a list of IPv4 addresses."""
+    return frozenset(int(ipaddress.IPv4Address(host)) for host in hosts)
+
+
 def get_scanner(hass, config):
     """Validate the configuration and return a ArpScan scanner."""
     return ArpScanDeviceScanner(config[DOMAIN])
 
-Device = namedtuple('Device', ['mac', 'name', 'ip', 'last_update'])
+
+class Device:
+    """A device seen during a scan."""
+
+    __slots__ = ('mac', 'ip', 'last_update')
+
+    def __init__(self, mac, ip, last_update):
+        """Initialize the device."""
+        self.mac = mac
+        self.ip = ip
+        self.last_update = last_update
+
+    def __repr__(self):
+        """Return the representation of the device."""
+        return 'Device(mac={!r}, ip={!r}, last_update={!r})'.format(
+            self.mac, self.ip, self.last_update)
+
 
 class ArpScanDeviceScanner(DeviceScanner):
     """This class scans for devices using arp-scan."""
 
-    exclude = []
-    include = []
+    exclude = frozenset()
+    include = frozenset()
 
     def __init__(self, config):
         """Initialize the scanner."""
         self.last_results = []
-
-        self.exclude = config[CONF_EXCLUDE]
-        self.include = config[CONF_INCLUDE]
-        self._options = config[CONF_OPTIONS]
-
-        _LOGGER.debug("Installing arp-scan package")
-        proc = subprocess.Popen('apk add arp-scan', shell=True, stdin=None, stdout=None, stderr=None, executable="/bin/bash")
-        proc.wait()
+        self._by_mac = {}
+
+        self.exclude = _ip_keys(config[CONF_EXCLUDE])
+        self.include = _ip_keys(config[CONF_INCLUDE])
+        self._options = tuple(shlex.split(config[CONF_OPTIONS]))
+        self._interface, self._ranges = _parse_scan_options(self._options)
+        self._native = True
+        self._prober = None
+        self._targets = []
+        self._known_targets = []
+        self._last_full_scan = 0.0
+        self._not_ready_logged = False
+
+        if self._ranges is None:
+            self._use_arp_scan("scan_options name targets it cannot handle")
+        else:
+            self._start_prober()
 
         self.success_init = self._update_info()
 
@@ -81,10 +221,143 @@ class ArpScanDeviceScanner(DeviceScanner):
 
     def get_extra_attributes(self, device):
         """Return the IP of the given device."""
-        filter_ip = next(
-            (result.ip for result in self.last_results if result.mac == device), None
-        )
-        return {"ip": filter_ip}
+        result = self._by_mac.get(device)
+        return {"ip": result.ip if result else None}
+
+
+    def _use_arp_scan(self, reason):
+        """Switch to scanning with the arp-scan binary."""
+        _LOGGER.warning(
+            "Native ARP probing unavailable (%s), using arp-scan", reason)
+        self._native = False
+
+        _LOGGER.debug("Installing arp-scan package")
+        proc = subprocess.Popen('apk add arp-scan', shell=True, stdin=None, stdout=None, stderr=None, executable="/bin/bash")
+        proc.wait()
+
+
+    def _setup_prober(self):
+        """Resolve the interface and addresses to probe and open the socket."""
+        interface = self._interface or get_default_interface()
+        if interface is None:
+            raise OSError("no network interface found")
+        ranges = self._ranges or (
+            network_range(get_interface_network(interface)),)
+
+        self._targets = range_targets(ranges)
+        self._prober = ArpProber(interface)
+        _LOGGER.debug("Probing %d addresses on %s",
+                      len(self._targets), interface)
+
+
+    def _start_prober(self):
+        """
+        Set up the native prober.
+        Only switches to arp-scan when raw sockets cannot work here or the
+        network is too large, other errors (interface not up yet) are
+        retried on the next scan.
+        """
+        if not hasattr(socket, 'AF_PACKET'):
+            self._use_arp_scan("no AF_PACKET support on this platform")
+            return
+
+        try:
+            self._setup_prober()
+        except ValueError as err:
+            # Too many addresses to probe natively
+            self._use_arp_scan(err)
+        except OSError as err:
+            if err.errno in (errno.EPERM, errno.EACCES):
+                self._use_arp_scan(err)
+            else:
+                # Warn once, a missing interface would flood the log
+                log = _LOGGER.debug if self._not_ready_logged \
+                    else _LOGGER.warning
+                log("Native ARP probing not ready (%s), retrying next scan",
+                    err)
+                self._not_ready_logged = True
+        else:
+            self._not_ready_logged = False
+
+
+    def _reset_prober(self):
+        """Close the prober so the interface is resolved again next scan."""
+        if self._prober is not None:
+            self._prober.close()
+        self._prober = None
+        self._targets = []
+        self._known_targets = []
+
+
+    def _probe(self):
+        """
+        Probe the network with raw ARP requests.
+        The whole network is swept every FULL_SCAN_INTERVAL, in between
+        only the hosts found by the last sweep are probed.
+        Returns (ip, mac) tuples, the IP as 32-bit integer.
+        """
+        now = time.monotonic()
+        full_scan_due = (now - self._last_full_scan
+                         >= FULL_SCAN_INTERVAL.total_seconds())
+
+        if self._known_targets and not full_scan_due:
+            replies = self._prober.probe_known(self._known_targets)
+        else:
+            replies = self._prober.probe(self._targets)
+            self._known_targets = [int.from_bytes(ip, 'big')
+                                   for _, ip in replies]
+            self._last_full_scan = now
+
+        return [(int.from_bytes(ip, 'big'), mac.hex(':'))
+                for mac, ip in replies]
+
+
+    def _arp_scan(self):
+        """
+        Probe the network using the arp-scan binary.
+        Returns (ip, mac) tuples, the IP as 32-bit integer, or None if
+        arp-scan failed.
+        """
+        hosts = []
+        messages = []
+        # stderr is merged into stdout so diagnostics are kept without
+        # risking a deadlock on a second pipe
+        with subprocess.Popen(["arp-scan", *self._options],
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.STDOUT) as proc:
+            for line in proc.stdout:
+                # Host lines are "<ip>\t<mac>\t<vendor>", keep everything
+                # else as diagnostics
+                ip_end = line.find(b'\t')
+                if not 0x30 <= line[0] <= 0x39 or ip_end < 0:
+                    messages.append(line)
+                    continue
+                mac_end = line.find(b'\t', ip_end + 1)
+
+                ipv4 = line[:ip_end].decode('ascii')
+                if ipv4.count('.') != 3:
+                    messages.append(line)
+                    continue
+                try:
+                    ip_key = int.from_bytes(socket.inet_aton(ipv4), 'big')
+                except OSError:
+                    messages.append(line)
+                    continue
+                if mac_end < 0:
+                    mac = line[ip_end + 1:].rstrip()
+                else:
+                    mac = line[ip_end + 1:mac_end]
+                hosts.append((ip_key, mac.decode('ascii')))
+
+        if proc.returncode != 0:
+            _LOGGER.error("arp-scan failed with exit code %d: %s",
+                          proc.returncode,
+                          b''.join(messages).decode(errors='replace').strip())
+            return None
+
+        _LOGGER.debug("arp-scan found %d hosts, output: %s", len(hosts),
+                      b''.join(messages).decode(errors='replace').strip())
+        return hosts
 
 
     @Throttle(MIN_TIME_BETWEEN_SCANS)
@@ -95,41 +368,43 @@ class ArpScanDeviceScanner(DeviceScanner):
         """
         _LOGGER.debug("Scanning...")
 
-        options = self._options
-
-        last_results = []
         exclude_hosts = self.exclude
         include_hosts = self.include
 
-        """ignore exclude if include present"""
-        if include_hosts:
-            exclude_hosts = []
-
-        scandata = subprocess.getoutput("arp-scan "+options)
-        _LOGGER.debug("Scandata %s", scandata)
+        if self._native and self._prober is None:
+            self._start_prober()
+            if self._native and self._prober is None:
+                return False
+
+        try:
+            if not self._native:
+                hosts = self._arp_scan()
+            else:
+                hosts = self._probe()
+        except OSError as err:
+            _LOGGER.error("ARP scan failed: %s", err)
+            if self._native:
+                self._reset_prober()
+            return False
+        if hosts is None:
+            return False
 
         now = dt_util.now()
-        for line in scandata.splitlines():
-            ipv4 = re.findall(r'[0-9]+(?:\.[0-9]+){3}', line)
-            if not ipv4:
-                continue
-
-            parts = line.split()
-            ipv4 = parts[0]
-
-            if include_hosts:
-                if not ipv4 in include_hosts:
-                    _LOGGER.debug("Excluded %s", ipv4)
-                    continue
-
-            if ipv4 in exclude_hosts:
-                _LOGGER.debug("Excluded %s", ipv4)
-                continue
-
-            mac = parts[1]
-            last_results.append(Device(mac, mac.replace(':', ''), ipv4, now))
+        """ignore exclude if include present"""
+        if include_hosts:
+            hosts_found = [(ip, mac) for ip, mac in hosts
+                           if ip in include_hosts]
+        else:
+            hosts_found = [(ip, mac) for ip, mac in hosts
+                           if ip not in exclude_hosts]
+        last_results = [
+            Device(mac, socket.inet_ntoa(ip.to_bytes(4, 'big')), now)
+            for ip, mac in hosts_found]
+        _LOGGER.debug("Excluded %d of %d hosts",
+                      len(hosts) - len(last_results), len(hosts))
 
         self.last_results = last_results
+        self._by_mac = {result.mac: result for result in last_results}
 
         _LOGGER.debug("Arpscan successful")
         return True